@@ -1,10 +1,20 @@
 from datetime import datetime
 from meteostat import Point, Hourly
+import numpy as np
 import pandas as pd
-from time import sleep
+import pyarrow as pa
+import pyarrow.dataset as ds
 import json
+import orjson
+from geopy.adapters import RequestsAdapter
+from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
 
+# Mesmo cache local do pipeline: arquivos de estação já baixados na última
+# hora são lidos do disco ao invés de baixados de novo
+Hourly.cache_dir = '.meteostat_cache'
+Hourly.max_age = 3600
+
 triangulo_mineiro = [
     "Uberlândia", 
     "Uberaba", 
@@ -38,69 +48,63 @@ triangulo_mineiro = [
 ]
 
 
-def get_geolocation(country_name: str, city_name: str):
-    # Crie um objeto geocodificador
-    geolocator = Nominatim(user_agent="dados-meteorologicos_paulo.hjs@hotmail.com")
-
+def get_geolocation(geocode, country_name: str, city_name: str):
     # Nome do local que você quer pesquisar
     local = f"{city_name}, {country_name}"
 
-    # Realiza a geocodificação
-    localizacao = geolocator.geocode(local)
+    # Realiza a geocodificação (o RateLimiter já espera 1s entre chamadas)
+    localizacao = geocode(local)
 
     # Verifica se a geocodificação foi bem-sucedida
     if localizacao:
-        latitude = localizacao.latitude
-        longitude = localizacao.longitude
-
-        # Prepara o dado para ser salvo
-        data = {local: {'latitude': latitude, 'longitude': longitude}}
-
-        # Lê o arquivo JSON existente, se houver
-        try:
-            with open('cities_geocode.json', 'r', encoding='utf-8') as cities_geocode:
-                all_data = json.load(cities_geocode)
-        except (FileNotFoundError, json.JSONDecodeError):
-            # Se o arquivo não existe ou está vazio, inicializa a lista
-            all_data = []
-
-        # Adiciona os novos dados
-        all_data.append(data)
-
-        # Escreve os dados no arquivo novamente
-        with open('cities_geocode.json', 'w', encoding= 'utf-8') as cities_geocode:
-            json.dump(all_data, cities_geocode, indent=4)
-
         print(f"Local {local} geocodificado com sucesso!")
+        return local, {'latitude': localizacao.latitude, 'longitude': localizacao.longitude}
     else:
         print(f"Local {local} não encontrado.")
+        return local, None
 
 
 def main():
 
+    # Cria o geocodificador uma única vez, com sessão HTTP persistente;
+    # o RateLimiter garante 1 req/s (política de uso do Nominatim)
+    geolocator = Nominatim(user_agent="dados-meteorologicos_paulo.hjs@hotmail.com", adapter_factory=RequestsAdapter)
+    geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1)
+
+    # Carrega o cache de geocódigos de execuções anteriores, se houver;
+    # numa nova execução só as cidades que faltam vão para a API
+    cities_geocode_file = 'cities_geocode.json'
+    try:
+        with open(cities_geocode_file, 'rb') as cities_geocode_json:
+            cities_geocode = orjson.loads(cities_geocode_json.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        cities_geocode = {}
+
+    # Acumula os geocódigos em memória como dict plano {local: {lat, lon}}
     for city in triangulo_mineiro:
-        get_geolocation('Brasil', city)
-        sleep(30)
+        if f"{city}, Brasil" in cities_geocode:
+            print(f"Local {city}, Brasil já geocodificado, usando o cache.")
+            continue
+        local, coords = get_geolocation(geocode, 'Brasil', city)
+        if coords:
+            cities_geocode[local] = coords
+
+    # Escreve o arquivo JSON uma única vez, ao invés de reescrever por cidade
+    with open(cities_geocode_file, 'w', encoding='utf-8') as cities_geocode_json:
+        json.dump(cities_geocode, cities_geocode_json, indent=4)
 
-    
     # defining variables
     start = datetime(2021, 1, 1, 20) #iniciando onde tem dados de todas as colunas de todas as cidades
     end = datetime(2024, 11, 15)
-    df_weather_data = pd.DataFrame
-    cities_geocode_file = 'cities_geocode.json'
-
-    # Get cities geocode from json
-    with open(cities_geocode_file, 'r', encoding='utf-8') as cities_geocode_json:
-        cities_geocode = json.load(cities_geocode_json)
+    # Acumula o DataFrame de cada cidade numa lista; concatenar dentro do loop
+    # copiaria o DataFrame acumulado inteiro a cada cidade
+    weather_data_frames = []
 
-    
     # Get weather data by city
-    for city in cities_geocode:
-        # Setting latitude and longitude by city
-        for name, coords in city.items():
-            print(f'Cidade: {name}, Latitude: {coords["latitude"]}')
-            latitude = coords['latitude']
-            longitude = coords['longitude']
+    for name, coords in cities_geocode.items():
+        print(f'Cidade: {name}, Latitude: {coords["latitude"]}')
+        latitude = coords['latitude']
+        longitude = coords['longitude']
 
         # Seting variable Point by city
         point = Point(latitude, longitude)
@@ -111,18 +115,40 @@ def main():
         if not data.empty:
             # Transform index (time) in simple column
             data = data.reset_index()
-            # Add column with name of city
-            data['city'] = name
+            # Add column with name of city como categórica: 4 bytes por linha de
+            # código int32 ao invés de um objeto string repetido em cada linha
+            data['city'] = pd.Categorical.from_codes(np.zeros(len(data), dtype='int32'), categories=[name])
             data = data[['city', 'time','temp', 'rhum', 'prcp', 'wspd']]
-            # concat city df on amount df
-            if df_weather_data.empty:
-                df_weather_data = data
-            else:
-                df_weather_data = pd.concat([df_weather_data, data])
-                df_weather_data = df_weather_data.reset_index(drop=True)
-
-    
-    df_weather_data.to_parquet('weather_data.parquet')
+            # append city df on frames list
+            weather_data_frames.append(data)
+
+    # Uma única concatenação no final; ignore_index já dispensa o reset_index
+    df_weather_data = pd.concat(weather_data_frames, ignore_index=True)
+    # O concat desfaz a categórica quando as categorias diferem; recategoriza
+    # para que o pyarrow escreva a coluna city já dicionarizada
+    df_weather_data['city'] = df_weather_data['city'].astype('category')
+
+    # Ordena por cidade e tempo para que as estatísticas min/max de cada row
+    # group fiquem bem delimitadas, permitindo pular páginas inteiras na leitura
+    df_weather_data = df_weather_data.sort_values(['city', 'time'], ignore_index=True)
+    # Meteostat retorna float64, mas os dados só têm ~1 casa decimal de precisão;
+    # float32 + zstd deixam os arquivos ~4x menores
+    df_weather_data[['temp', 'rhum', 'prcp', 'wspd']] = df_weather_data[['temp', 'rhum', 'prcp', 'wspd']].astype('float32')
+    # Escreve no mesmo layout particionado por cidade que o pipeline incremental
+    # usa (weather_data/city=<nome>/part-*.parquet), assim os appends diários
+    # nunca precisam reescrever a carga inicial; row group de 8760 linhas =
+    # ~1 ano de dados horários de uma cidade
+    df_weather_data_table = pa.Table.from_pandas(df_weather_data, preserve_index=False)
+    ds.write_dataset(
+        df_weather_data_table,
+        'weather_data',
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([('city', pa.string())]), flavor='hive'),
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'),
+        existing_data_behavior='delete_matching',
+        basename_template='part-initial-{i}.parquet',
+        max_rows_per_group=8760
+    )
       
 
 